@@ -2,46 +2,125 @@
 import pefile
 import os
 import hashlib
-import array
+import csv
 import math
+import mmap
+import numpy as np
+from bisect import bisect_right
+from itertools import accumulate, chain
+from multiprocessing import Pool
+from operator import attrgetter
 
-def get_md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Header fields extracted as is, in CSV column order
+_file_header_getter = attrgetter(
+    'Machine', 'SizeOfOptionalHeader', 'Characteristics')
+_optional_header_getter = attrgetter(
+    'MajorLinkerVersion', 'MinorLinkerVersion', 'SizeOfCode',
+    'SizeOfInitializedData', 'SizeOfUninitializedData',
+    'AddressOfEntryPoint', 'BaseOfCode')
+_optional_header_tail_getter = attrgetter(
+    'ImageBase', 'SectionAlignment', 'FileAlignment',
+    'MajorOperatingSystemVersion', 'MinorOperatingSystemVersion',
+    'MajorImageVersion', 'MinorImageVersion', 'MajorSubsystemVersion',
+    'MinorSubsystemVersion', 'SizeOfImage', 'SizeOfHeaders', 'CheckSum',
+    'Subsystem', 'DllCharacteristics', 'SizeOfStackReserve',
+    'SizeOfStackCommit', 'SizeOfHeapReserve', 'SizeOfHeapCommit',
+    'LoaderFlags', 'NumberOfRvaAndSizes')
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _entropy_u8(a):
+        """Shannon entropy of a uint8 array, histogram and sum in one pass"""
+        counts = np.zeros(256, np.int64)
+        for i in range(a.size):
+            counts[a[i]] += 1
+        n = a.size
+        entropy = 0.0
+        for c in counts:
+            if c:
+                p_x = c / n
+                entropy -= p_x * math.log2(p_x)
+        return entropy
+else:
+    def _entropy_u8(a):
+        counts = np.bincount(a, minlength=256)
+        p_x = counts[counts > 0].astype(np.float64) / a.size
+        return -(p_x * np.log2(p_x)).sum()
 
 def get_entropy(data):
     if len(data) == 0:
         return 0.0
-    occurences = array.array('L', [0] * 256)
-    for x in data:
-        occurences[x if isinstance(x, int) else ord(x)] += 1
-    entropy = 0
-    for x in occurences:
-        if x:
-            p_x = float(x) / len(data)
-            entropy -= p_x * math.log(p_x, 2)
+    return float(_entropy_u8(np.frombuffer(data, dtype=np.uint8)))
+
+def get_mapped_entropy(mm, start, end):
+    """Entropy of mm[start:end], read in place from the mapped file.
+    Callers pass the file range pefile's get_data() would read, end is
+    clamped to the file size like a slice"""
+    end = min(end, len(mm))
+    if end <= start:
+        return 0.0
+    return float(_entropy_u8(np.frombuffer(mm, dtype=np.uint8, count=end - start, offset=start)))
 
-    return entropy
+def get_section_ranges(pe, file_size):
+    """Return the sections RVA ranges, sorted by start :
+    [start, end, raw offset, raw end]
+    Bounds follow pefile's SectionStructure.contains_rva() and get_data()"""
+    ranges = []
+    for section in pe.sections:
+        start = section.get_VirtualAddress_adj()
+        raw = section.get_PointerToRawData_adj()
+        # A SizeOfRawData running past the end of the file is not trusted
+        if file_size - raw < section.SizeOfRawData:
+            size = section.Misc_VirtualSize
+        else:
+            size = max(section.SizeOfRawData, section.Misc_VirtualSize)
+        # Cut the section where the next one in the table starts
+        next_va = section.next_section_virtual_address
+        if next_va is not None and next_va > section.VirtualAddress and start + size > next_va:
+            size = next_va - start
+        ranges.append((start, start + size, raw,
+                       section.PointerToRawData + section.SizeOfRawData))
+    ranges.sort()
+    return ranges
 
-def get_resources(pe):
+def get_raw_range(ranges, starts, reach, rva, size):
+    """Map a RVA range to a file offset range.
+    None outside of the sections, or when several sections contain the RVA
+    since pe.get_data() then depends on the section table order"""
+    i = bisect_right(starts, rva) - 1
+    if i < 0 or rva >= ranges[i][1] or reach[i] > rva:
+        return None
+    start, _, raw, raw_end = ranges[i]
+    offset = rva - start + raw
+    return offset, min(offset + size, raw_end)
+
+def get_resources(pe, mm):
     """Extract resources :
     [entropy, size]"""
     resources = []
     if hasattr(pe, 'DIRECTORY_ENTRY_RESOURCE'):
+        ranges = get_section_ranges(pe, len(mm))
+        starts = [r[0] for r in ranges]
+        # reach[i]: furthest end of the ranges sorted before ranges[i]
+        reach = list(accumulate((r[1] for r in ranges[:-1]), max, initial=0))
         try:
             for resource_type in pe.DIRECTORY_ENTRY_RESOURCE.entries:
                 if hasattr(resource_type, 'directory'):
                     for resource_id in resource_type.directory.entries:
                         if hasattr(resource_id, 'directory'):
                             for resource_lang in resource_id.directory.entries:
-                                data = pe.get_data(
-                                    resource_lang.data.struct.OffsetToData,
-                                    resource_lang.data.struct.Size)
+                                rva = resource_lang.data.struct.OffsetToData
                                 size = resource_lang.data.struct.Size
-                                entropy = get_entropy(data)
+                                raw_range = get_raw_range(ranges, starts, reach, rva, size)
+                                if raw_range is None:
+                                    entropy = get_entropy(pe.get_data(rva, size))
+                                else:
+                                    entropy = get_mapped_entropy(mm, *raw_range)
 
                                 resources.append([entropy, size])
         except Exception as e:
@@ -59,7 +138,8 @@ def get_version_info(pe):
                     res[entry[0]] = entry[1]
         if fileinfo.Key == 'VarFileInfo':
             for var in fileinfo.Var:
-                res[var.entry.items()[0][0]] = var.entry.items()[0][1]
+                k, v = next(iter(var.entry.items()))
+                res[k] = v
     if hasattr(pe, 'VS_FIXEDFILEINFO'):
         res['flags'] = pe.VS_FIXEDFILEINFO.FileFlags
         res['os'] = pe.VS_FIXEDFILEINFO.FileOS
@@ -74,123 +154,131 @@ def get_version_info(pe):
 def extract_infos(fpath):
     res = []
     res.append(os.path.basename(fpath))
-    res.append(get_md5(fpath))
-    pe = pefile.PE(fpath)
-    #res.append(pe.get_imphash())
-    res.append(pe.FILE_HEADER.Machine)
-    res.append(pe.FILE_HEADER.SizeOfOptionalHeader)
-    res.append(pe.FILE_HEADER.Characteristics)
-    res.append(pe.OPTIONAL_HEADER.MajorLinkerVersion)
-    res.append(pe.OPTIONAL_HEADER.MinorLinkerVersion)
-    res.append(pe.OPTIONAL_HEADER.SizeOfCode)
-    res.append(pe.OPTIONAL_HEADER.SizeOfInitializedData)
-    res.append(pe.OPTIONAL_HEADER.SizeOfUninitializedData)
-    res.append(pe.OPTIONAL_HEADER.AddressOfEntryPoint)
-    res.append(pe.OPTIONAL_HEADER.BaseOfCode)
-    try:
-        res.append(pe.OPTIONAL_HEADER.BaseOfData)
-    except AttributeError:
-        res.append(0)
-    res.append(pe.OPTIONAL_HEADER.ImageBase)
-    res.append(pe.OPTIONAL_HEADER.SectionAlignment)
-    res.append(pe.OPTIONAL_HEADER.FileAlignment)
-    res.append(pe.OPTIONAL_HEADER.MajorOperatingSystemVersion)
-    res.append(pe.OPTIONAL_HEADER.MinorOperatingSystemVersion)
-    res.append(pe.OPTIONAL_HEADER.MajorImageVersion)
-    res.append(pe.OPTIONAL_HEADER.MinorImageVersion)
-    res.append(pe.OPTIONAL_HEADER.MajorSubsystemVersion)
-    res.append(pe.OPTIONAL_HEADER.MinorSubsystemVersion)
-    res.append(pe.OPTIONAL_HEADER.SizeOfImage)
-    res.append(pe.OPTIONAL_HEADER.SizeOfHeaders)
-    res.append(pe.OPTIONAL_HEADER.CheckSum)
-    res.append(pe.OPTIONAL_HEADER.Subsystem)
-    res.append(pe.OPTIONAL_HEADER.DllCharacteristics)
-    res.append(pe.OPTIONAL_HEADER.SizeOfStackReserve)
-    res.append(pe.OPTIONAL_HEADER.SizeOfStackCommit)
-    res.append(pe.OPTIONAL_HEADER.SizeOfHeapReserve)
-    res.append(pe.OPTIONAL_HEADER.SizeOfHeapCommit)
-    res.append(pe.OPTIONAL_HEADER.LoaderFlags)
-    res.append(pe.OPTIONAL_HEADER.NumberOfRvaAndSizes)
-    res.append(len(pe.sections))
-    entropy = list(map(lambda x:x.get_entropy(), pe.sections))
-    if len(entropy) > 0:
-        res.append(sum(entropy) / float(len(entropy)))
-        res.append(min(entropy))
-        res.append(max(entropy))
-    else:
-        res.append(0)
-        res.append(0)
-        res.append(0)
-    # Get the sizes of the raw data for each section
-    raw_sizes = list(map(lambda x: x.SizeOfRawData, pe.sections))
-    if len(raw_sizes) > 0:
-        # Compute some statistics on the raw data sizes
-        res.append(sum(raw_sizes) / float(len(raw_sizes)))
-        res.append(min(raw_sizes))
-        res.append(max(raw_sizes))
-    else:
-        res.append(0)
-        res.append(0)
-        res.append(0)
+    with open(fpath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise pefile.PEFormatError('The file is empty')
+        # Map the file once, both the hash and the PE parsing read from it
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        res.append(hashlib.md5(mm).hexdigest())
+        # Only parse the data directories the features below rely on
+        pe = pefile.PE(data=mm, fast_load=True)
+        pe.parse_data_directories(directories=[
+            pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_IMPORT'],
+            pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_EXPORT'],
+            pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_RESOURCE'],
+            pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_LOAD_CONFIG'],
+        ])
+        #res.append(pe.get_imphash())
+        res.extend(_file_header_getter(pe.FILE_HEADER))
+        optional_header = pe.OPTIONAL_HEADER
+        res.extend(_optional_header_getter(optional_header))
+        # BaseOfData only exists in PE32 optional headers
+        res.append(getattr(optional_header, 'BaseOfData', 0))
+        res.extend(_optional_header_tail_getter(optional_header))
+        sections = pe.sections
+        n_sections = len(sections)
+        res.append(n_sections)
+        # Gather the entropy, raw size and virtual size of each section in one pass
+        entropy = np.empty(n_sections, np.float64)
+        raw_sizes = np.empty(n_sections, np.int64)
+        virtual_sizes = np.empty(n_sections, np.int64)
+        for i, section in enumerate(sections):
+            raw_size = section.SizeOfRawData
+            # Same bounds as section.get_data(): start at the aligned
+            # PointerToRawData, never read past the unaligned end
+            start = section.get_PointerToRawData_adj()
+            end = min(start + raw_size, section.PointerToRawData + raw_size)
+            entropy[i] = get_mapped_entropy(mm, start, end)
+            raw_sizes[i] = raw_size
+            virtual_sizes[i] = section.Misc_VirtualSize
+        if entropy.size > 0:
+            res.append(entropy.mean())
+            res.append(entropy.min())
+            res.append(entropy.max())
+        else:
+            res.append(0)
+            res.append(0)
+            res.append(0)
+        if raw_sizes.size > 0:
+            # Compute some statistics on the raw data sizes
+            res.append(raw_sizes.mean())
+            res.append(raw_sizes.min())
+            res.append(raw_sizes.max())
+        else:
+            res.append(0)
+            res.append(0)
+            res.append(0)
 
-    # Get the virtual sizes for each section
-    virtual_sizes = list(map(lambda x: x.Misc_VirtualSize, pe.sections))
-    if len(virtual_sizes) > 0:
-        # Compute some statistics on the virtual sizes
-        res.append(sum(virtual_sizes) / float(len(virtual_sizes)))
-        res.append(min(virtual_sizes))
-        res.append(max(virtual_sizes))
-    else:
-        res.append(0)
-        res.append(0)
-        res.append(0)
-    #Imports
-    try:
-        res.append(len(pe.DIRECTORY_ENTRY_IMPORT))
-        imports = sum([x.imports for x in pe.DIRECTORY_ENTRY_IMPORT], [])
-        res.append(len(imports))
-        res.append(len(list(filter(lambda x: x.name is None, imports))))
-    except AttributeError:
-        res.append(0)
-        res.append(0)
-        res.append(0)
-    #Exports
-    try:
-        res.append(len(pe.DIRECTORY_ENTRY_EXPORT.symbols))
-    except AttributeError:
-        # No export
-        res.append(0)
-    #Resources
-    resources = get_resources(pe)
-    res.append(len(resources))
-    if len(resources) > 0:
-        entropy = list(map(lambda x: x[0], resources))
-        res.append(sum(entropy) / float(len(entropy)))
-        res.append(min(entropy))
-        res.append(max(entropy))
-        sizes = list(map(lambda x: x[1], resources))
-        res.append(sum(sizes) / float(len(sizes)))
-        res.append(min(sizes))
-        res.append(max(sizes))
-    else:
-        res.append(0)
-        res.append(0)
-        res.append(0)
-        res.append(0)
-        res.append(0)
-        res.append(0)
+        if virtual_sizes.size > 0:
+            # Compute some statistics on the virtual sizes
+            res.append(virtual_sizes.mean())
+            res.append(virtual_sizes.min())
+            res.append(virtual_sizes.max())
+        else:
+            res.append(0)
+            res.append(0)
+            res.append(0)
+        #Imports
+        try:
+            res.append(len(pe.DIRECTORY_ENTRY_IMPORT))
+            imports = list(chain.from_iterable(x.imports for x in pe.DIRECTORY_ENTRY_IMPORT))
+            res.append(len(imports))
+            res.append(sum(1 for x in imports if x.name is None))
+        except AttributeError:
+            res.append(0)
+            res.append(0)
+            res.append(0)
+        #Exports
+        try:
+            res.append(len(pe.DIRECTORY_ENTRY_EXPORT.symbols))
+        except AttributeError:
+            # No export
+            res.append(0)
+        #Resources
+        resources = get_resources(pe, mm)
+        res.append(len(resources))
+        if len(resources) > 0:
+            entropy = list(map(lambda x: x[0], resources))
+            res.append(sum(entropy) / float(len(entropy)))
+            res.append(min(entropy))
+            res.append(max(entropy))
+            sizes = list(map(lambda x: x[1], resources))
+            res.append(sum(sizes) / float(len(sizes)))
+            res.append(min(sizes))
+            res.append(max(sizes))
+        else:
+            res.append(0)
+            res.append(0)
+            res.append(0)
+            res.append(0)
+            res.append(0)
+            res.append(0)
 
-    # Load configuration size
-    try:
-        res.append(pe.DIRECTORY_ENTRY_LOAD_CONFIG.struct.Size)
-    except AttributeError:
-        res.append(0)
-    # Version configuration size
+        # Load configuration size
+        try:
+            res.append(pe.DIRECTORY_ENTRY_LOAD_CONFIG.struct.Size)
+        except AttributeError:
+            res.append(0)
+        # Version configuration size
+        try:
+            version_infos = get_version_info(pe)
+            res.append(len(version_infos.keys()))
+        except AttributeError:
+            res.append(0)
+        return res
+
+def process(path_label):
+    """Extract the infos of one labelled file,
+    None if the PE file is not well-formed"""
+    fpath, label = path_label
+    print(os.path.basename(fpath))
     try:
-        version_infos = get_version_info(pe)
-        res.append(len(version_infos.keys()))
-    except AttributeError:
-        res.append(0)
+        res = extract_infos(fpath)
+    except pefile.PEFormatError:
+        print('\t -> Bad PE format')
+        return None
+    res.append(label)
     return res
 
 if __name__ == '__main__':
@@ -216,49 +304,23 @@ if __name__ == '__main__':
         "LoadConfigurationSize", "VersionInformationSize", "legitimate"
     ]
 
-    # Launch legitimate
-    # Open the file for writing
-    outFile = "output_test.csv"
-    with open(outFile, 'a') as ff:
-        # Write the header row to the file
-        ff.write(csv_delimiter.join(columns) + "\n")
-
-        # Loop over all files in the 'legitimate' directory
-        for ffile in os.listdir('legitimate'):
-            print(ffile)
-
-            # Attempt to extract information from the PE file
-            try:
-                # Call the extract_infos() function to get information about the file
-                res = extract_infos(os.path.join('legitimate/', ffile))
-
-                # Append a label indicating that the file is legitimate (1)
-                res.append(1)
-
-                # Convert the list of extracted information to a CSV row and write it to the file
-                ff.write(csv_delimiter.join(map(str, res)) + "\n")
-
-            # Handle the case where the PE file is not well-formed
-            except pefile.PEFormatError:
-                print('\t -> Bad PE format')
+    # Label each sample: legitimate (1) or malicious (0)
+    paths = []
+    for directory, label in [('legitimate', 1), ('malicious', 0)]:
+        with os.scandir(directory) as it:
+            paths += [(entry.path, label) for entry in it if entry.is_file()]
 
     # Open the file for writing
-    with open(outFile, 'a') as ff:
-        # Loop over all files in the 'legitimate' directory
-        for ffile in os.listdir('malicious'):
-            print(ffile)
-
-            # Attempt to extract information from the PE file
-            try:
-                # Call the extract_infos() function to get information about the file
-                res = extract_infos(os.path.join('malicious/', ffile))
-
-                # Append a label indicating that the file is legitimate (1)
-                res.append(0)
-
-                # Convert the list of extracted information to a CSV row and write it to the file
-                ff.write(csv_delimiter.join(map(str, res)) + "\n")
+    outFile = "output_test.csv"
+    with open(outFile, 'a', buffering=1 << 20, newline='') as ff:
+        writer = csv.writer(ff, delimiter=csv_delimiter, lineterminator="\n")
+        # Write the header row, unless we are appending to a previous run
+        if os.path.getsize(outFile) == 0:
+            writer.writerow(columns)
 
-            # Handle the case where the PE file is not well-formed
-            except pefile.PEFormatError:
-                print('\t -> Bad PE format')
+        # Every PE file is independent, parse them in parallel and write
+        # the rows from this process as they come back
+        with Pool(os.cpu_count()) as p:
+            for res in p.imap_unordered(process, paths, chunksize=16):
+                if res:
+                    writer.writerow(res)
@@ -5,23 +5,17 @@ This file extracts the required information of a given file using the library PE
 
 import pefile
 import os
-import array
-import math
+import numpy as np
+from itertools import chain
 import joblib
 import sys
 
 def get_entropy(data):
     if len(data) == 0:
         return 0.0
-    occurences = array.array('L', [0]*256)
-    for x in data:
-        occurences[x if isinstance(x, int) else ord(x)] += 1
-    entropy = 0
-    for x in occurences:
-        if x:
-            p_x = float(x) / len(data)
-            entropy -= p_x*math.log(p_x, 2)
-    return entropy
+    counts = np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256)
+    p_x = counts[counts > 0].astype(np.float64) / len(data)
+    return float(-(p_x * np.log2(p_x)).sum())
 
 def get_resources(pe):
     """
@@ -49,7 +43,8 @@ def get_version_info(pe):
                     res[entry[0]] = entry[1]
         if fileinfo.Key == 'VarFileInfo':
             for var in fileinfo.Var:
-                res[var.entry.items()[0][0]] = var.entry.items()[0][1]
+                k, v = next(iter(var.entry.items()))
+                res[k] = v
     if hasattr(pe, 'VS_FIXEDFILEINFO'):
           res['flags'] = pe.VS_FIXEDFILEINFO.FileFlags
           res['os'] = pe.VS_FIXEDFILEINFO.FileOS
@@ -122,9 +117,9 @@ def extract_infos(fpath):
     #Imports
     try:
         res['ImportsNbDLL'] = len(pe.DIRECTORY_ENTRY_IMPORT)
-        imports = sum([x.imports for x in pe.DIRECTORY_ENTRY_IMPORT], [])
+        imports = list(chain.from_iterable(x.imports for x in pe.DIRECTORY_ENTRY_IMPORT))
         res['ImportsNb'] = len(imports)
-        res['ImportsNbOrdinal'] = len(list(filter(lambda x:x.name is None, imports)))
+        res['ImportsNbOrdinal'] = sum(1 for x in imports if x.name is None)
     except AttributeError:
         res['ImportsNbDLL'] = 0
         res['ImportsNb'] = 0